@@ -1,32 +1,80 @@
+import functools
+import threading
+from collections import defaultdict
 from numbers import Number
+from typing import Dict
+from typing import Iterator
+from typing import List
 from typing import Optional
 from typing import Sequence
 from typing import Tuple
 from typing import Union
 
 import numpy as np
+from scipy.spatial.transform import Rotation
 import SimpleITK as sitk
 import torch
+import torch.nn.functional as F
+from torch.utils.dlpack import from_dlpack
+from torch.utils.dlpack import to_dlpack
 
 from .. import RandomTransform
 from ... import SpatialTransform
 from ....constants import INTENSITY
 from ....constants import TYPE
-from ....data.io import nib_to_sitk
+from ....data.image import Image
+from ....data.io import get_sitk_metadata_from_ras_affine
 from ....data.subject import Subject
 from ....typing import TypeRangeFloat
 from ....typing import TypeSextetFloat
 from ....typing import TypeTripletFloat
-from ....utils import get_major_sitk_version
 from ....utils import to_tuple
 
 
 TypeOneToSixFloat = Union[TypeRangeFloat, TypeTripletFloat, TypeSextetFloat]
 
+# Interpolation modes that can be computed with F.grid_sample for CUDA tensors
+GRID_SAMPLE_MODES = {
+    'linear': 'bilinear',
+}
+
+# Interpolation modes that can be computed with CuPy for CUDA tensors
+SPLINE_ORDERS = {
+    'bspline': 3,
+    'cubic': 3,
+}
+
+# Data types that SimpleITK does not support, and NumPy neither for bfloat16.
+# They are converted to float32 before the values are passed to these libraries
+HALF_DTYPES = (torch.float16, torch.bfloat16)
+
+# Borders smaller than this are processed with Numba, if it is installed, as
+# the overhead of the NumPy temporaries dominates for small arrays
+JIT_MAX_BORDER_SIZE = 100_000
+
+
+class _Resamplers(threading.local):
+    """One SimpleITK resampler per thread, created lazily and reused.
+
+    The resampler is configured for each image, so sharing it between threads
+    that run the same transform would mix their images.
+    """
+
+    resampler: Optional[sitk.ResampleImageFilter] = None
+
+    def __reduce__(self):
+        # SimpleITK filters cannot be pickled or deep-copied
+        return self.__class__, ()
+
 
 class RandomAffine(RandomTransform, SpatialTransform):
     r"""Apply a random affine transformation and resample the image.
 
+    .. note::
+        Label maps resampled with nearest neighbor interpolation keep their
+        data type, e.g., ``torch.uint8`` or ``torch.int64``. In previous
+        versions of TorchIO, they were converted to ``torch.float32``.
+
     Args:
         scales: Tuple :math:`(a_1, b_1, a_2, b_2, a_3, b_3)` defining the
             scaling ranges.
@@ -90,6 +138,18 @@ class RandomAffine(RandomTransform, SpatialTransform):
         check_shape: If ``True`` an error will be raised if the images are in
             different physical spaces. If ``False``, :attr:`center` should
             probably not be ``'image'`` but ``'center'``.
+        itk_threads: Number of threads used by SimpleITK to resample images.
+            CUDA tensors are resampled on the GPU when possible, and SimpleITK
+            is used for the rest. If ``None``, the SimpleITK default is used.
+            If the transform runs in several
+            :class:`~torch.utils.data.DataLoader` workers, ``1`` is
+            recommended to avoid oversubscribing the CPU.
+        output_dtype: Floating point data type of the transformed intensity
+            images. For example, ``torch.float16`` or ``torch.bfloat16`` halve
+            the memory used by the output, which is convenient when training
+            with mixed precision. Label maps resampled with nearest neighbor
+            interpolation keep their data type, and are ``torch.float32``
+            otherwise.
         **kwargs: See :class:`~torchio.transforms.Transform` for additional
             keyword arguments.
 
@@ -124,6 +184,8 @@ class RandomAffine(RandomTransform, SpatialTransform):
         image_interpolation: str = 'linear',
         label_interpolation: str = 'nearest',
         check_shape: bool = True,
+        itk_threads: Optional[int] = None,
+        output_dtype: torch.dtype = torch.float32,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -144,6 +206,10 @@ class RandomAffine(RandomTransform, SpatialTransform):
             label_interpolation,
         )
         self.check_shape = check_shape
+        self.itk_threads = _parse_itk_threads(itk_threads)
+        self.output_dtype = _parse_output_dtype(output_dtype)
+        # Shared with the Affine transforms created in apply_transform
+        self._resamplers = _Resamplers()
 
     def get_params(
         self,
@@ -151,12 +217,17 @@ class RandomAffine(RandomTransform, SpatialTransform):
         degrees: TypeSextetFloat,
         translation: TypeSextetFloat,
         isotropic: bool,
-    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-        scaling_params = self.sample_uniform_sextet(scales)
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # All the parameters are sampled at once with the PyTorch RNG, so
+        # that seeding with torch.manual_seed still works
+        ranges = np.array((scales, degrees, translation), dtype=float)
+        low, high = np.moveaxis(ranges.reshape(3, 3, 2), -1, 0)
+        uniform = torch.rand(3, 3, dtype=torch.float64).numpy()
+        scaling_params, rotation_params, translation_params = (
+            low + (high - low) * uniform
+        )
         if isotropic:
-            scaling_params.fill_(scaling_params[0])
-        rotation_params = self.sample_uniform_sextet(degrees)
-        translation_params = self.sample_uniform_sextet(translation)
+            scaling_params[:] = scaling_params[0]
         return scaling_params, rotation_params, translation_params
 
     def apply_transform(self, subject: Subject) -> Subject:
@@ -175,8 +246,12 @@ class RandomAffine(RandomTransform, SpatialTransform):
             'image_interpolation': self.image_interpolation,
             'label_interpolation': self.label_interpolation,
             'check_shape': self.check_shape,
+            'itk_threads': self.itk_threads,
+            'output_dtype': self.output_dtype,
         }
         transform = Affine(**self.add_include_exclude(arguments))
+        # The resamplers are reused across calls
+        transform._resamplers = self._resamplers
         transformed = transform(subject)
         assert isinstance(transformed, Subject)
         return transformed
@@ -185,6 +260,11 @@ class RandomAffine(RandomTransform, SpatialTransform):
 class Affine(SpatialTransform):
     r"""Apply affine transformation.
 
+    .. note::
+        Label maps resampled with nearest neighbor interpolation keep their
+        data type, e.g., ``torch.uint8`` or ``torch.int64``. In previous
+        versions of TorchIO, they were converted to ``torch.float32``.
+
     Args:
         scales: Tuple :math:`(s_1, s_2, s_3)` defining the
             scaling values along each dimension.
@@ -208,6 +288,18 @@ class Affine(SpatialTransform):
         check_shape: If ``True`` an error will be raised if the images are in
             different physical spaces. If ``False``, :attr:`center` should
             probably not be ``'image'`` but ``'center'``.
+        itk_threads: Number of threads used by SimpleITK to resample images.
+            CUDA tensors are resampled on the GPU when possible, and SimpleITK
+            is used for the rest. If ``None``, the SimpleITK default is used.
+            If the transform runs in several
+            :class:`~torch.utils.data.DataLoader` workers, ``1`` is
+            recommended to avoid oversubscribing the CPU.
+        output_dtype: Floating point data type of the transformed intensity
+            images. For example, ``torch.float16`` or ``torch.bfloat16`` halve
+            the memory used by the output, which is convenient when training
+            with mixed precision. Label maps resampled with nearest neighbor
+            interpolation keep their data type, and are ``torch.float32``
+            otherwise.
         **kwargs: See :class:`~torchio.transforms.Transform` for additional
             keyword arguments.
     """
@@ -222,6 +314,8 @@ class Affine(SpatialTransform):
         image_interpolation: str = 'linear',
         label_interpolation: str = 'nearest',
         check_shape: bool = True,
+        itk_threads: Optional[int] = None,
+        output_dtype: torch.dtype = torch.float32,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -258,6 +352,8 @@ class Affine(SpatialTransform):
         )
         self.invert_transform = False
         self.check_shape = check_shape
+        self.itk_threads = _parse_itk_threads(itk_threads)
+        self.output_dtype = _parse_output_dtype(output_dtype)
         self.args_names = [
             'scales',
             'degrees',
@@ -267,131 +363,402 @@ class Affine(SpatialTransform):
             'image_interpolation',
             'label_interpolation',
             'check_shape',
+            'output_dtype',
         ]
+        # Reused for all the images and calls in the same thread
+        self._resamplers = _Resamplers()
+
+    def _get_resampler(self) -> sitk.ResampleImageFilter:
+        resampler = self._resamplers.resampler
+        if resampler is None:
+            resampler = sitk.ResampleImageFilter()
+            if self.itk_threads is not None:
+                resampler.SetNumberOfThreads(self.itk_threads)
+            self._resamplers.resampler = resampler
+        return resampler
 
     @staticmethod
-    def _get_scaling_transform(
-        scaling_params: Sequence[float],
-        center_lps: Optional[TypeTripletFloat] = None,
-    ) -> sitk.ScaleTransform:
-        # 1.5 means the objects look 1.5 times larger
-        transform = sitk.ScaleTransform(3)
-        scaling_params_array = np.array(scaling_params).astype(float)
-        transform.SetScale(scaling_params_array)
-        if center_lps is not None:
-            transform.SetCenter(center_lps)
-        return transform
-
-    @staticmethod
-    def _get_rotation_transform(
-        degrees: Sequence[float],
-        translation: Sequence[float],
-        center_lps: Optional[TypeTripletFloat] = None,
-    ) -> sitk.Euler3DTransform:
-        def ras_to_lps(triplet: Sequence[float]):
-            return np.array((-1, -1, 1), dtype=float) * np.asarray(triplet)
-
-        transform = sitk.Euler3DTransform()
-        radians = np.radians(degrees).tolist()
-
-        # SimpleITK uses LPS
-        radians_lps = ras_to_lps(radians)
-        translation_lps = ras_to_lps(translation)
-
-        transform.SetRotation(*radians_lps)
-        transform.SetTranslation(translation_lps)
-        if center_lps is not None:
-            transform.SetCenter(center_lps)
-        return transform
-
-    def get_affine_transform(self, image):
-        scaling = np.asarray(self.scales).copy()
-        rotation = np.asarray(self.degrees).copy()
-        translation = np.asarray(self.translation).copy()
+    def _get_rotation_matrix(degrees: np.ndarray) -> np.ndarray:
+        # Same convention as sitk.Euler3DTransform, i.e. R = Rz @ Rx @ Ry.
+        # Uppercase axes are intrinsic rotations, applied from left to right
+        rx, ry, rz = degrees
+        return Rotation.from_euler('ZXY', (rz, rx, ry), degrees=True).as_matrix()
+
+    def get_affine_matrix(self, image: Image) -> np.ndarray:
+        """Get the 4×4 matrix that maps input to output points in RAS+.
+
+        The rotation and scaling around the center, and the translation, are
+        folded into a single matrix, so they are applied only once per voxel.
+        """
+        scaling = np.asarray(self.scales, dtype=float).copy()
+        rotation = np.asarray(self.degrees, dtype=float).copy()
+        translation = np.asarray(self.translation, dtype=float)
 
         if image.is_2d():
             scaling[2] = 1
             rotation[:-1] = 0
 
         if self.use_image_center:
-            center_lps = image.get_center(lps=True)
+            center_index = (np.asarray(image.spatial_shape) - 1) / 2
+            center = image.affine[:3, :3] @ center_index + image.affine[:3, 3]
         else:
-            center_lps = None
+            center = np.zeros(3)
 
-        scaling_transform = self._get_scaling_transform(
-            scaling,
-            center_lps=center_lps,
-        )
-        rotation_transform = self._get_rotation_transform(
-            rotation,
-            translation,
-            center_lps=center_lps,
-        )
+        linear = np.diag(scaling) @ self._get_rotation_matrix(rotation)
+        matrix = np.eye(4)
+        matrix[:3, :3] = linear
+        matrix[:3, 3] = scaling * translation + center - linear @ center
+
+        if self.invert_transform:
+            matrix = np.linalg.inv(matrix)
+        return matrix
 
-        sitk_major_version = get_major_sitk_version()
-        if sitk_major_version == 1:
-            transform = sitk.Transform(3, sitk.sitkComposite)
-            transform.AddTransform(scaling_transform)
-            transform.AddTransform(rotation_transform)
-        elif sitk_major_version == 2:
-            transforms = [scaling_transform, rotation_transform]
-            transform = sitk.CompositeTransform(transforms)
+    def get_affine_transform(self, image: Image) -> sitk.AffineTransform:
+        """Get the SimpleITK transform from the output to the input space."""
+        return self._get_sitk_transform(self.get_affine_matrix(image))
 
+    @staticmethod
+    def _get_sitk_transform(matrix: np.ndarray) -> sitk.AffineTransform:
         # ResampleImageFilter expects the transform from the output space to
         # the input space. Intuitively, the passed arguments should take us
         # from the input space to the output space, so we need to invert the
         # transform.
         # More info at https://github.com/fepegar/torchio/discussions/693
-        transform = transform.GetInverse()
+        matrix = np.linalg.inv(matrix)
 
-        if self.invert_transform:
-            transform = transform.GetInverse()
+        # SimpleITK uses LPS
+        ras_to_lps = np.diag((-1, -1, 1, 1))
+        matrix = ras_to_lps @ matrix @ ras_to_lps
 
+        transform = sitk.AffineTransform(3)
+        transform.SetMatrix(matrix[:3, :3].flatten().tolist())
+        transform.SetTranslation(matrix[:3, 3].tolist())
         return transform
 
+    def get_default_values(self, image: Image) -> torch.Tensor:
+        """Get one pad value per channel, on the same device as the image."""
+        tensor = image.data
+        num_channels = len(tensor)
+        if image[TYPE] != INTENSITY:
+            return torch.zeros(num_channels, device=tensor.device)
+        if self.default_pad_value == 'minimum':
+            # Computed on the device to avoid a synchronization
+            return tensor.amin(dim=(1, 2, 3))
+        elif self.default_pad_value in ('mean', 'otsu'):
+            filter_otsu = self.default_pad_value == 'otsu'
+            if tensor.dtype in HALF_DTYPES:
+                tensor = tensor.float()
+            default_values = [
+                _get_borders_mean(channel.cpu().numpy(), filter_otsu)
+                for channel in tensor
+            ]
+            return torch.as_tensor(default_values, device=tensor.device)
+        else:
+            assert isinstance(self.default_pad_value, Number)
+            default_value = float(self.default_pad_value)
+            return torch.full((num_channels,), default_value, device=tensor.device)
+
     def apply_transform(self, subject: Subject) -> Subject:
         if self.check_shape:
             subject.check_consistent_spatial_shape()
-        default_value: float
+        # Channels that need SimpleITK and share interpolation, pad value and
+        # physical space are resampled together, as a single vector image
+        sitk_groups: Dict[tuple, List[Tuple[torch.Tensor, torch.Tensor]]]
+        sitk_groups = defaultdict(list)
+        sitk_spaces: Dict[tuple, Image] = {}
+        sitk_outputs: List[Tuple[Image, torch.Tensor]] = []
+        # The matrix only depends on the shape and affine of the image
+        matrices: Dict[tuple, np.ndarray] = {}
+        # Images that are not intensity images are treated as label maps
+        interpolations = {INTENSITY: self.image_interpolation}
+        output_dtypes = {INTENSITY: self.output_dtype}
         for image in self.get_images(subject):
-            transform = self.get_affine_transform(image)
-            transformed_tensors = []
-            for tensor in image.data:
-                sitk_image = nib_to_sitk(
-                    tensor[np.newaxis],
-                    image.affine,
-                    force_3d=True,
+            data = image.data
+            affine = image.affine
+            geometry = data.shape[1:], affine.tobytes()
+            if geometry not in matrices:
+                matrices[geometry] = self.get_affine_matrix(image)
+            matrix = matrices[geometry]
+            image_type = image[TYPE]
+            interpolation = interpolations.get(image_type, self.label_interpolation)
+            dtype = output_dtypes.get(image_type, torch.float32)
+            if interpolation == 'nearest' and image_type != INTENSITY:
+                dtype = data.dtype
+            default_values = self.get_default_values(image)
+            # SimpleITK is faster than PyTorch on the CPU, so the values are
+            # only resampled with PyTorch or CuPy if they are on the GPU
+            if data.is_cuda and interpolation == 'nearest':
+                transformed = self.apply_affine_nearest(
+                    data,
+                    affine,
+                    matrix,
+                    default_values,
+                    dtype,
                 )
-                if image[TYPE] != INTENSITY:
-                    interpolation = self.label_interpolation
-                    default_value = 0
-                else:
-                    interpolation = self.image_interpolation
-                    if self.default_pad_value == 'minimum':
-                        default_value = tensor.min().item()
-                    elif self.default_pad_value == 'mean':
-                        default_value = get_borders_mean(
-                            sitk_image,
-                            filter_otsu=False,
-                        )
-                    elif self.default_pad_value == 'otsu':
-                        default_value = get_borders_mean(
-                            sitk_image,
-                            filter_otsu=True,
-                        )
-                    else:
-                        assert isinstance(self.default_pad_value, Number)
-                        default_value = float(self.default_pad_value)
-                transformed_tensor = self.apply_affine_transform(
-                    sitk_image,
-                    transform,
+                image.set_data(transformed)
+            elif data.is_cuda and interpolation in GRID_SAMPLE_MODES:
+                transformed = self.apply_affine_grid(
+                    data,
+                    affine,
+                    matrix,
                     interpolation,
-                    default_value,
+                    default_values,
+                    dtype,
                 )
-                transformed_tensors.append(transformed_tensor)
-            image.set_data(torch.stack(transformed_tensors))
+                image.set_data(transformed)
+            elif (
+                data.is_cuda and interpolation in SPLINE_ORDERS and _is_cupy_available()
+            ):
+                transformed = self.apply_affine_cupy(
+                    data,
+                    affine,
+                    matrix,
+                    interpolation,
+                    default_values,
+                    dtype,
+                )
+                image.set_data(transformed)
+            else:
+                transformed = torch.empty(data.shape, dtype=dtype, device=data.device)
+                # SimpleITK needs the pad values as Python floats
+                pad_values = default_values.tolist()
+                for tensor, output, default_value in zip(data, transformed, pad_values):
+                    key = interpolation, default_value, geometry
+                    sitk_groups[key].append((tensor, output))
+                sitk_spaces.setdefault(geometry, image)
+                sitk_outputs.append((image, transformed))
+
+        # The SimpleITK metadata and transform are the same for all the
+        # images in the same physical space, so they are computed only once
+        sitk_geometries = {}
+        for geometry, image in sitk_spaces.items():
+            metadata = get_sitk_metadata_from_ras_affine(image.affine)
+            transform = self._get_sitk_transform(matrices[geometry])
+            sitk_geometries[geometry] = metadata, transform
+
+        for key, channels in sitk_groups.items():
+            interpolation, default_value, geometry = key
+            (origin, spacing, direction), transform = sitk_geometries[geometry]
+            tensors = [tensor for tensor, _ in channels]
+            dtypes = [tensor.dtype for tensor in tensors]
+            dtype = functools.reduce(torch.promote_types, dtypes)
+            if dtype in HALF_DTYPES:
+                dtype = torch.float32
+            # The channels are copied into a buffer that is already contiguous
+            # in ITK order, so GetImageFromArray does not need another copy
+            itk_shape = *tensors[0].shape[::-1], len(tensors)
+            buffer = torch.empty(itk_shape, dtype=dtype)
+            for i, tensor in enumerate(tensors):
+                buffer[..., i] = tensor.permute(2, 1, 0)  # NumPy to ITK
+            array = buffer.numpy()
+            is_vector = len(tensors) > 1
+            if not is_vector:
+                array = array[..., 0]
+            sitk_image = sitk.GetImageFromArray(array, isVector=is_vector)
+            sitk_image.SetOrigin(origin)
+            sitk_image.SetSpacing(spacing)
+            sitk_image.SetDirection(direction)
+            self._resample_sitk_image(
+                sitk_image,
+                transform,
+                interpolation,
+                default_value,
+                [output for _, output in channels],
+            )
+        for image, transformed in sitk_outputs:
+            image.set_data(transformed)
         return subject
 
+    @staticmethod
+    def _get_sampling_grid(
+        spatial_shape: Sequence[int],
+        affine: np.ndarray,
+        matrix: np.ndarray,
+        device: torch.device,
+    ) -> torch.Tensor:
+        """Get the input coordinates of the output voxels for F.grid_sample.
+
+        The grid has shape :math:`(1, W, H, D, 3)` and is in the normalized
+        coordinates of :func:`torch.nn.functional.grid_sample`, which go from
+        -1 to 1 and are sorted as :math:`(k, j, i)`.
+        """
+        # Output voxel -> output world -> input world -> input voxel
+        voxel_matrix = np.linalg.inv(affine) @ np.linalg.inv(matrix) @ affine
+
+        shape = np.array(spatial_shape)
+        to_normalized = np.eye(4)
+        to_normalized[:3, :3] = np.diag(2 / shape)
+        to_normalized[:3, 3] = 1 / shape - 1
+        to_normalized = to_normalized[(2, 1, 0, 3), :]
+        theta = to_normalized @ voxel_matrix @ np.linalg.inv(to_normalized)
+
+        theta_tensor = torch.as_tensor(theta[:3], dtype=torch.float32, device=device)
+        grid = F.affine_grid(
+            theta_tensor.unsqueeze(0),
+            [1, 1, *spatial_shape],
+            align_corners=False,
+        )
+        return grid
+
+    @staticmethod
+    def _get_voxel_matrix(
+        affine: np.ndarray,
+        matrix: np.ndarray,
+        device: torch.device,
+    ) -> torch.Tensor:
+        # Output voxel -> output world -> input world -> input voxel
+        voxel_matrix = np.linalg.inv(affine) @ np.linalg.inv(matrix) @ affine
+        return torch.as_tensor(voxel_matrix, device=device)
+
+    @staticmethod
+    def _get_shifted_coordinates(
+        voxel_matrix: torch.Tensor,
+        spatial_shape: Sequence[int],
+    ) -> Iterator[Tuple[torch.Tensor, int]]:
+        """Yield the input coordinates of the output voxels along each axis.
+
+        The coordinates are shifted by half a voxel, so that the image spans
+        :math:`[0, N]` along an axis of size :math:`N` and truncating the
+        coordinates rounds them to the nearest voxel, as in ITK.
+        """
+        device = voxel_matrix.device
+        # Output indices along each axis, ready for broadcasting
+        i, j, k = (
+            torch.arange(size, dtype=torch.float64, device=device).reshape(shape)
+            for size, shape in zip(spatial_shape, ((-1, 1, 1), (-1, 1), (-1,)))
+        )
+        for row, size in zip(voxel_matrix, spatial_shape):
+            yield row[0] * i + row[1] * j + (row[2] * k + row[3] + 0.5), size
+
+    @classmethod
+    def _get_inside_mask(
+        cls,
+        voxel_matrix: torch.Tensor,
+        spatial_shape: Sequence[int],
+    ) -> torch.Tensor:
+        device = voxel_matrix.device
+        inside = torch.ones(spatial_shape, dtype=torch.bool, device=device)
+        for coordinates, size in cls._get_shifted_coordinates(
+            voxel_matrix,
+            spatial_shape,
+        ):
+            inside &= (coordinates >= 0) & (coordinates <= size)
+        return inside
+
+    @staticmethod
+    def _fill_outside(
+        resampled: torch.Tensor,
+        inside: torch.Tensor,
+        default_values: torch.Tensor,
+    ) -> torch.Tensor:
+        # As in ITK, points up to half a voxel outside the image take the
+        # values at the border, and the rest are filled with the pad value
+        pad_values = default_values.to(resampled).reshape(-1, 1, 1, 1)
+        return torch.where(inside, resampled, pad_values)
+
+    @classmethod
+    def apply_affine_nearest(
+        cls,
+        tensor: torch.Tensor,
+        affine: np.ndarray,
+        matrix: np.ndarray,
+        default_values: torch.Tensor,
+        dtype: torch.dtype,
+    ) -> torch.Tensor:
+        """Resample a 4D tensor with nearest neighbor interpolation.
+
+        The input voxel closest to each output voxel is gathered directly, on
+        the tensor's device and without casting the values to floating point.
+        """
+        device = tensor.device
+        spatial_shape = tensor.shape[1:]
+        voxel_matrix = cls._get_voxel_matrix(affine, matrix, device)
+        flat_indices = torch.zeros(spatial_shape, dtype=torch.int64, device=device)
+        inside = torch.ones(spatial_shape, dtype=torch.bool, device=device)
+        for coordinates, size in cls._get_shifted_coordinates(
+            voxel_matrix,
+            spatial_shape,
+        ):
+            # Computed here to avoid computing the coordinates twice
+            inside &= (coordinates >= 0) & (coordinates <= size)
+            indices = coordinates.clamp_(0, size - 1).long()
+            flat_indices.mul_(size).add_(indices)
+
+        resampled = tensor.flatten(1)[:, flat_indices.flatten()]
+        resampled = resampled.reshape(tensor.shape).to(dtype)
+        return cls._fill_outside(resampled, inside, default_values)
+
+    def apply_affine_grid(
+        self,
+        tensor: torch.Tensor,
+        affine: np.ndarray,
+        matrix: np.ndarray,
+        interpolation: str,
+        default_values: torch.Tensor,
+        dtype: torch.dtype = torch.float32,
+    ) -> torch.Tensor:
+        """Resample a 4D tensor using PyTorch, on the tensor's device.
+
+        The values are sampled in single precision, so they may differ
+        slightly from those computed by SimpleITK, which uses double precision
+        for the sampling coordinates.
+        """
+        floating = tensor.float()
+        grid = self._get_sampling_grid(
+            floating.shape[1:],
+            affine,
+            matrix,
+            floating.device,
+        )
+        resampled = F.grid_sample(
+            floating.unsqueeze(0),
+            grid,
+            mode=GRID_SAMPLE_MODES[interpolation],
+            padding_mode='border',
+            align_corners=False,
+        )[0]
+        del grid  # free memory before computing the mask
+        inside = self._get_inside_mask(
+            self._get_voxel_matrix(affine, matrix, resampled.device),
+            resampled.shape[1:],
+        )
+        resampled = self._fill_outside(resampled, inside, default_values)
+        return resampled.to(dtype)
+
+    def apply_affine_cupy(
+        self,
+        tensor: torch.Tensor,
+        affine: np.ndarray,
+        matrix: np.ndarray,
+        interpolation: str,
+        default_values: torch.Tensor,
+        dtype: torch.dtype = torch.float32,
+    ) -> torch.Tensor:
+        """Resample a 4D CUDA tensor with B-splines using CuPy."""
+        import cupy
+        from cupyx.scipy import ndimage
+
+        voxel_matrix = np.linalg.inv(affine) @ np.linalg.inv(matrix) @ affine
+        voxel_matrix_cupy = cupy.asarray(voxel_matrix)
+        resampled_channels = []
+        for channel in tensor.to(torch.float64):
+            array = cupy.from_dlpack(to_dlpack(channel.contiguous()))
+            # Mirror boundary conditions, as in ITK
+            resampled_array = ndimage.affine_transform(
+                array,
+                voxel_matrix_cupy,
+                order=SPLINE_ORDERS[interpolation],
+                mode='mirror',
+            )
+            resampled_channels.append(from_dlpack(resampled_array.toDlpack()))
+        resampled = torch.stack(resampled_channels)
+        inside = self._get_inside_mask(
+            self._get_voxel_matrix(affine, matrix, resampled.device),
+            resampled.shape[1:],
+        )
+        resampled = self._fill_outside(resampled, inside, default_values)
+        return resampled.to(dtype)
+
     def apply_affine_transform(
         self,
         sitk_image: sitk.Image,
@@ -399,46 +766,207 @@ class Affine(SpatialTransform):
         interpolation: str,
         default_value: float,
     ) -> torch.Tensor:
+        num_components = sitk_image.GetNumberOfComponentsPerPixel()
+        outputs = torch.empty(num_components, *sitk_image.GetSize())
+        self._resample_sitk_image(
+            sitk_image,
+            transform,
+            interpolation,
+            default_value,
+            list(outputs),
+        )
+        return outputs if num_components > 1 else outputs[0]
+
+    def _resample_sitk_image(
+        self,
+        sitk_image: sitk.Image,
+        transform: sitk.Transform,
+        interpolation: str,
+        default_value: float,
+        outputs: Sequence[torch.Tensor],
+    ) -> None:
+        """Resample an image and write each component into a 3D tensor."""
         floating = reference = sitk_image
+        is_vector = sitk_image.GetNumberOfComponentsPerPixel() > 1
+        if is_vector:
+            pixel_type = sitk.sitkVectorFloat32
+        else:
+            pixel_type = sitk.sitkFloat32
 
-        resampler = sitk.ResampleImageFilter()
+        resampler = self._get_resampler()
         resampler.SetInterpolator(self.get_sitk_interpolator(interpolation))
         resampler.SetReferenceImage(reference)
         resampler.SetDefaultPixelValue(float(default_value))
-        resampler.SetOutputPixelType(sitk.sitkFloat32)
+        resampler.SetOutputPixelType(pixel_type)
         resampler.SetTransform(transform)
         resampled = resampler.Execute(floating)
 
-        np_array = sitk.GetArrayFromImage(resampled)
+        # The view is only valid while the resampled image exists, so its
+        # values are copied straight into the outputs
+        np_array = sitk.GetArrayViewFromImage(resampled)
+        if not is_vector:
+            np_array = np_array[..., np.newaxis]
         np_array = np_array.transpose()  # ITK to NumPy
-        tensor = torch.as_tensor(np_array)
-        return tensor
+        for component, output in zip(np_array, outputs):
+            # NumPy does not support bfloat16
+            if output.device.type == 'cpu' and output.dtype != torch.bfloat16:
+                output.numpy()[:] = component
+            else:
+                output.copy_(torch.from_numpy(np.ascontiguousarray(component)))
+
+
+def _get_borders(array: np.ndarray) -> np.ndarray:
+    """Get the values at the borders of a 3D array, each voxel only once."""
+    dtype = array.dtype
+    faces = []
+    for _ in range(array.ndim):
+        faces.append(array[0])
+        if len(array) > 1:
+            faces.append(array[-1])
+        # Remove the faces that have already been collected and move to the
+        # next axis
+        array = np.moveaxis(array[1:-1], 0, -1)
+    size = sum(face.size for face in faces)
+    borders = np.empty(size, dtype=dtype)
+    start = 0
+    for face in faces:
+        # Copy without creating a flattened copy of the face first
+        borders[start : start + face.size].reshape(face.shape)[...] = face
+        start += face.size
+    return borders
+
+
+def get_borders_mean(image: sitk.Image, filter_otsu: bool = True) -> float:
+    array = sitk.GetArrayViewFromImage(image)
+    return _get_borders_mean(array, filter_otsu)
 
 
-def get_borders_mean(image, filter_otsu=True):
-    array = sitk.GetArrayViewFromImage(image)
-    borders_tuple = (
-        array[0, :, :],
-        array[-1, :, :],
-        array[:, 0, :],
-        array[:, -1, :],
-        array[:, :, 0],
-        array[:, :, -1],
-    )
-    borders_flat = np.hstack([border.ravel() for border in borders_tuple])
+def _get_borders_mean(array: np.ndarray, filter_otsu: bool = True) -> float:
+    borders_flat = _get_borders(array)
     if not filter_otsu:
         return borders_flat.mean()
-    borders_reshaped = borders_flat.reshape(1, 1, -1)
-    borders_image = sitk.GetImageFromArray(borders_reshaped)
-    otsu = sitk.OtsuThresholdImageFilter()
-    otsu.Execute(borders_image)
-    threshold = otsu.GetThreshold()
-    values = borders_flat[borders_flat < threshold]
-    if values.any():
-        default_value = values.mean()
+    return _get_otsu_mean(borders_flat)
+
+
+def _get_otsu_mean(values: np.ndarray, num_bins: int = 128) -> float:
+    """Compute the mean of the values below the Otsu threshold.
+
+    The threshold is the one computed by
+    :class:`SimpleITK.OtsuThresholdImageFilter`, i.e., the upper edge of a bin
+    of a histogram with 128 bins, cast to the data type of the values. If all
+    the values below the threshold are zero, the mean of all the values is
+    returned.
+    """
+    if values.dtype == np.float16:
+        # Not supported by Numba, and imprecise for the mean
+        values = values.astype(np.float32)
+    minimum, maximum = values.min(), values.max()
+    if minimum == maximum:
+        return values.mean()
+    if values.dtype in (np.int8, np.uint8):
+        # As in ITK, 8-bit histograms cover all the possible values
+        info = np.iinfo(values.dtype)
+        lower = info.min - 0.5
+        upper = info.max + 0.5
+    else:
+        # As in ITK, the upper bound is extended so that the maximum is
+        # inside the last bin
+        lower = float(minimum)
+        upper = float(maximum) + (float(maximum) - float(minimum)) / num_bins / 100
+    width = (upper - lower) / num_bins
+
+    otsu_jit = None
+    if values.size < JIT_MAX_BORDER_SIZE:
+        otsu_jit = _get_otsu_jit()
+    if otsu_jit is not None:
+        histogram_loop, lower_mean_loop = otsu_jit
+        # A single floating point type avoids compiling the functions for
+        # every integer type
+        floating = values
+        if values.dtype not in (np.float32, np.float64):
+            floating = values.astype(np.float64)
+        histogram = histogram_loop(floating, lower, width, num_bins)
     else:
-        default_value = borders_flat.mean()
-    return default_value
+        indices = ((values - lower) / width).astype(np.intp)
+        np.clip(indices, 0, num_bins - 1, out=indices)
+        histogram = np.bincount(indices, minlength=num_bins)
+
+    bin_centers = lower + (np.arange(num_bins) + 0.5) * width
+    probabilities = histogram / histogram.sum()
+    # Probability and mean of the class below each threshold
+    weights = probabilities.cumsum()
+    means = (probabilities * bin_centers).cumsum()
+    total_mean = means[-1]
+    # Between-class variance up to a constant, as in ITK
+    upper_weights = 1 - weights
+    valid = (weights > 0) & (upper_weights > 0)
+    between_class_variance = np.zeros(num_bins)
+    between_class_variance[valid] = (
+        means[valid] ** 2 / weights[valid]
+        + (total_mean - means[valid]) ** 2 / upper_weights[valid]
+    )
+    # The first maximum is used, as in ITK
+    threshold_bin = between_class_variance[:-1].argmax()
+    threshold = values.dtype.type(lower + (threshold_bin + 1) * width)
+
+    if otsu_jit is not None:
+        return lower_mean_loop(floating, float(threshold), floating.mean())
+    lower_values = values[values < threshold]
+    if lower_values.any():
+        return lower_values.mean()
+    return values.mean()
+
+
+def _histogram_loop(
+    values: np.ndarray,
+    lower: float,
+    width: float,
+    num_bins: int,
+) -> np.ndarray:
+    """Loop version of :func:`numpy.bincount`, meant to be compiled by Numba."""
+    histogram = np.zeros(num_bins, dtype=np.int64)
+    for value in values:
+        index = min(max(int((value - lower) / width), 0), num_bins - 1)
+        histogram[index] += 1
+    return histogram
+
+
+def _lower_mean_loop(values: np.ndarray, threshold: float, default: float) -> float:
+    """Compute the mean of the values below a threshold with a single loop.
+
+    If all these values are zero, the default value is returned. This function
+    is meant to be compiled by Numba.
+    """
+    total = 0.0
+    count = 0
+    any_nonzero = False
+    for value in values:
+        if value < threshold:
+            total += value
+            count += 1
+            any_nonzero = any_nonzero or value != 0
+    if not any_nonzero:
+        return default
+    return total / count
+
+
+@functools.lru_cache(maxsize=None)
+def _get_otsu_jit():
+    try:
+        import numba
+    except ImportError:
+        return None
+    jit = numba.njit(cache=True, fastmath=True)
+    return jit(_histogram_loop), jit(_lower_mean_loop)
+
+
+@functools.lru_cache(maxsize=None)
+def _is_cupy_available() -> bool:
+    try:
+        import cupy  # noqa: F401
+    except ImportError:
+        return False
+    return True
 
 
 def _parse_scales_isotropic(scales, isotropic):
@@ -460,3 +988,21 @@ def _parse_default_value(value: Union[str, float]) -> Union[str, float]:
         'Value for default_pad_value must be "minimum", "otsu", "mean" or a number'
     )
     raise ValueError(message)
+
+
+def _parse_itk_threads(itk_threads: Optional[int]) -> Optional[int]:
+    if itk_threads is None:
+        return None
+    # bool is a subclass of int, but True is not a valid number of threads
+    is_int = isinstance(itk_threads, int) and not isinstance(itk_threads, bool)
+    if is_int and itk_threads > 0:
+        return itk_threads
+    message = f'"itk_threads" must be a positive integer or None, not {itk_threads}'
+    raise ValueError(message)
+
+
+def _parse_output_dtype(dtype: torch.dtype) -> torch.dtype:
+    if isinstance(dtype, torch.dtype) and dtype.is_floating_point:
+        return dtype
+    message = f'"output_dtype" must be a floating point torch.dtype, not {dtype}'
+    raise ValueError(message)
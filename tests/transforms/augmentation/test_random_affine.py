@@ -1,3 +1,8 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import numpy as np
 import pytest
 import torch
 import torchio as tio
@@ -71,6 +76,192 @@ class TestRandomAffine(TorchioTestCase):
     def test_otsu(self):
         tio.RandomAffine(default_pad_value='otsu')(self.sample_subject)
 
+    def test_otsu_mean_jit(self):
+        from torchio.transforms.augmentation.spatial import random_affine
+
+        pytest.importorskip('numba')
+        values = self.sample_subject.t1.numpy().ravel()[:1000]
+        arrays = (
+            values,
+            values.astype(np.float16),
+            (values > values.mean()).astype(np.uint8) * np.uint8(3),
+        )
+        for array in arrays:
+            jit_mean = random_affine._get_otsu_mean(array)
+            # Force the NumPy implementation
+            with patch.object(random_affine, 'JIT_MAX_BORDER_SIZE', 0):
+                numpy_mean = random_affine._get_otsu_mean(array)
+            assert jit_mean == pytest.approx(numpy_mean)
+
+    def test_otsu_mean_reference(self):
+        from torchio.transforms.augmentation.spatial import random_affine
+
+        bimodal = np.concatenate((np.linspace(0, 1, 50), np.linspace(10, 11, 50)))
+        # Expected values computed with SimpleITK's OtsuThresholdImageFilter
+        cases = (
+            # The values below the threshold are all zero, so all are used
+            (np.repeat(np.arange(4, dtype=np.uint8), (10, 20, 30, 40)), 2),
+            (bimodal.astype(np.float32), 0.5),
+            # The threshold is 2, as it is cast to the integer type
+            (np.repeat(np.array((0, 1, 2, 10, 11, 12), dtype=np.int16), 10), 0.5),
+            (np.repeat(np.array((1, 2, 3, 10), dtype=np.int16), 10), 1.5),
+        )
+        for values, expected in cases:
+            assert random_affine._get_otsu_mean(values) == pytest.approx(expected)
+            with patch.object(random_affine, 'JIT_MAX_BORDER_SIZE', 0):
+                numpy_mean = random_affine._get_otsu_mean(values)
+            assert numpy_mean == pytest.approx(expected)
+
+    def test_bspline(self):
+        # Interpolation not supported by grid_sample, resampled with SimpleITK
+        transform = tio.RandomAffine(
+            scales=(1, 1),
+            degrees=(0, 0),
+            default_pad_value=0,
+            image_interpolation='bspline',
+        )
+        transformed = transform(self.sample_subject)
+        self.assert_tensor_almost_equal(
+            self.sample_subject.t1.data,
+            transformed.t1.data,
+        )
+
+    def test_pickle_after_resampling(self):
+        # The cached SimpleITK resampler must not be pickled
+        transform = tio.Affine(1, 10, 0, image_interpolation='bspline')
+        transformed = transform(self.sample_subject)
+        unpickled = pickle.loads(pickle.dumps(transform))
+        self.assert_tensor_equal(
+            transformed.t1.data,
+            unpickled(self.sample_subject).t1.data,
+        )
+
+    def test_resampler_reused(self):
+        transform = tio.RandomAffine(image_interpolation='bspline')
+        transform(self.sample_subject)
+        resampler = transform._resamplers.resampler
+        assert resampler is not None
+        transform(self.sample_subject)
+        assert transform._resamplers.resampler is resampler
+        unpickled = pickle.loads(pickle.dumps(transform))
+        assert unpickled._resamplers.resampler is None
+        unpickled(self.sample_subject)
+
+    def test_resampler_threads(self):
+        # Each thread must use its own resampler
+        transform = tio.Affine(1, 10, 0, image_interpolation='bspline')
+        images = [
+            tio.ScalarImage(tensor=torch.rand(1, 10 + i % 4, 11 + i % 3, 12))
+            for i in range(16)
+        ]
+        expected = [transform(image).data for image in images]
+        with ThreadPoolExecutor(8) as executor:
+            for _ in range(5):
+                results = executor.map(transform, images)
+                for result, tensor in zip(results, expected):
+                    self.assert_tensor_equal(result.data, tensor)
+
+    def test_itk_threads(self):
+        affine = tio.Affine(1, 0, 0, itk_threads=1)
+        assert affine._get_resampler().GetNumberOfThreads() == 1
+        transform = tio.RandomAffine(image_interpolation='bspline', itk_threads=1)
+        transform(self.sample_subject)
+        assert transform._resamplers.resampler.GetNumberOfThreads() == 1
+
+    def test_wrong_itk_threads(self):
+        for itk_threads in (0, True, 1.0):
+            with pytest.raises(ValueError):
+                tio.RandomAffine(itk_threads=itk_threads)
+
+    def test_output_dtype(self):
+        transform = tio.RandomAffine(output_dtype=torch.float16)
+        transformed = transform(self.sample_subject)
+        assert transformed.t1.data.dtype == torch.float16
+        assert transformed.label.data.dtype == self.sample_subject.label.data.dtype
+
+    def test_chained_half_output_dtype(self):
+        for dtype in (torch.float16, torch.bfloat16):
+            transform = tio.Compose(
+                [
+                    tio.RandomAffine(output_dtype=dtype),
+                    tio.RandomAffine(
+                        image_interpolation='bspline',
+                        default_pad_value='otsu',
+                        output_dtype=dtype,
+                    ),
+                    tio.RandomAffine(default_pad_value='mean'),
+                ],
+            )
+            transformed = transform(self.sample_subject)
+            assert transformed.t1.data.dtype == torch.float32
+
+    def test_wrong_output_dtype(self):
+        with pytest.raises(ValueError):
+            tio.RandomAffine(output_dtype=torch.int16)
+
+    def test_grid_sample_matches_sitk(self):
+        image = self.sample_subject.t1
+        affine = tio.Affine(scales=1.1, degrees=10, translation=2, default_pad_value=-1)
+        expected = affine(image).data
+        resampled = affine.apply_affine_grid(
+            image.data,
+            image.affine,
+            affine.get_affine_matrix(image),
+            'linear',
+            torch.tensor([-1.0]),
+        )
+        self.assert_tensor_almost_equal(resampled, expected, rtol=1e-5, atol=1e-5)
+
+    def test_nearest_gather(self):
+        tensor = torch.arange(48, dtype=torch.int16).reshape(1, 4, 4, 3)
+        label = tio.LabelMap(tensor=tensor)
+        pad_values = torch.tensor([-1.0])
+        shifted = torch.full_like(tensor, -1)
+        shifted[:, 1:] = tensor[:, :-1]
+        # Points up to half a voxel outside take the value at the border
+        cases = ((0.5, tensor), (0.6, shifted), (1, shifted))
+        for translation, expected in cases:
+            affine = tio.Affine(1, 0, (translation, 0, 0))
+            resampled = affine.apply_affine_nearest(
+                tensor,
+                label.affine,
+                affine.get_affine_matrix(label),
+                pad_values,
+                tensor.dtype,
+            )
+            self.assert_tensor_equal(resampled, expected)
+            assert resampled.dtype == torch.int16
+
+        affine = tio.Affine(1, (0, 0, 90), 0)
+        resampled = affine.apply_affine_nearest(
+            tensor,
+            label.affine,
+            affine.get_affine_matrix(label),
+            pad_values,
+            tensor.dtype,
+        )
+        # Resampled with SimpleITK, as the tensor is on the CPU
+        self.assert_tensor_equal(resampled, affine(label).data)
+        assert not torch.equal(resampled, tensor)
+        # A rotation of 90 degrees around the center only permutes the voxels
+        values = resampled.flatten().sort().values
+        self.assert_tensor_equal(values, tensor.flatten())
+
+    def test_sitk_methods(self):
+        from torchio.transforms.augmentation.spatial import random_affine
+
+        image = self.sample_subject.t1
+        affine = tio.Affine(scales=1.1, degrees=10, translation=2, default_pad_value=-1)
+        expected = affine(image).data[0]
+        sitk_image = image.as_sitk()
+        transform = affine.get_affine_transform(image)
+        resampled = affine.apply_affine_transform(sitk_image, transform, 'linear', -1)
+        self.assert_tensor_almost_equal(resampled, expected)
+        array = image.data[0].numpy()
+        mean = random_affine.get_borders_mean(sitk_image, filter_otsu=False)
+        expected_mean = random_affine._get_borders_mean(array, filter_otsu=False)
+        assert mean == pytest.approx(expected_mean)
+
     def test_bad_center(self):
         with pytest.raises(ValueError):
             tio.RandomAffine(center='bad')